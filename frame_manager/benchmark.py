@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Frame manager benchmark
+
+Generate synthetic videos, gifs and image folders, run frame_manager.py on them with
+representative options and report frames/s, MB/s and peak memory. Each run is a new python
+process, as a command line call would be.
+
+Example:
+
+    python benchmark.py --save baseline.json
+    will run the benchmark and save the results to baseline.json
+
+    python benchmark.py --baseline baseline.json
+    will run the benchmark again and compare the results to baseline.json,
+    the exit code is 1 if a case is slower than the baseline by more than the tolerance
+
+    python benchmark.py --startup -n 20
+    will print the median import time of frame_manager and of its heavy dependencies,
+    and the median wall time of a python process importing frame_manager
+"""
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from math import sin
+from os import makedirs, path
+from shutil import rmtree
+from statistics import median
+from subprocess import DEVNULL, run
+from sys import executable, exit
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import cv2
+from numpy import ascontiguousarray, indices, ndarray, stack, uint8, zeros
+
+from frame_manager import write_gif
+
+FRAME_MANAGER_DIRECTORY = path.dirname(path.abspath(__file__))
+MODULES = ['numpy', 'cv2', 'PIL.Image', 'PIL.GifImagePlugin', 'tqdm', 'frame_manager']
+
+# name: frame_manager.py options, {overlay} is replaced by the path of the overlay image
+CASES = {
+    'plain': [],
+    'resize': ['-r', '0.5'],
+    'rotate_pad': ['-t', '15', '-g', '10,10,20,20,0,0,0,0'],
+    'overlap_skip': ['-v', '{overlay}', '-p', '2'],
+}
+OUTPUTS = {'gif': [], 'mp4': ['-m']}
+
+
+def import_time(module: str) -> float:
+    """Import a module in a new python process
+
+    Args:
+        - module: name of the module to import
+    Return:
+        - cumulative import time of the module in seconds, given by python -X importtime
+    """
+    process = run(
+        [executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=FRAME_MANAGER_DIRECTORY,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # last line: "import time: self [us] | cumulative | module", for the imported module
+    return int(process.stderr.strip().split('\n')[-1].split('|')[1]) / 1e6
+
+
+def startup_time() -> float:
+    """Start a python process which only imports frame_manager
+
+    Return:
+        - wall time of the process in seconds
+    """
+    start = perf_counter()
+    run([executable, '-c', 'import frame_manager'], cwd=FRAME_MANAGER_DIRECTORY, check=True)
+    return perf_counter() - start
+
+
+def benchmark_startup(repeat: int) -> List[str]:
+    """Measure the import times and the startup time, repeat times each
+
+    Return:
+        - report lines, with median times in ms
+    """
+    lines = []
+    for module in MODULES:
+        times = [import_time(module) for _ in range(repeat)]
+        lines.append('import {:<20} {:8.1f} ms'.format(module, median(times) * 1000))
+    times = [startup_time() for _ in range(repeat)]
+    lines.append('{:<27} {:8.1f} ms'.format('process startup', median(times) * 1000))
+    return lines
+
+
+def synthetic_frame(width: int, height: int, i: int) -> ndarray:
+    """Create a BGR frame: moving gradients and a moving disk, the same for each run
+
+    Args:
+        - width, height: size of the frame
+        - i: index of the frame
+    Return:
+        - frame
+    """
+    y, x = indices((height, width))
+    frame = stack([(x + 4 * i) % 256, (y + 2 * i) % 256, (x + y) // 2 % 256], axis=2)
+    frame = ascontiguousarray(frame, dtype=uint8)
+    center = (int(width * (0.5 + 0.3 * sin(i / 10))), height // 2)
+    cv2.circle(frame, center, height // 6, (255, 255, 255), -1)
+    return frame
+
+
+def generate_inputs(directory: str, width: int, height: int, length: int) -> Dict[str, str]:
+    """Create a .mp4 video, a .gif and a folder of .jpg images with the same synthetic frames
+
+    Return:
+        - path of each input, by kind: 'mp4', 'gif' and 'images'
+    """
+    name = '{}x{}_{}'.format(width, height, length)
+    inputs = {
+        'mp4': path.join(directory, name + '.mp4'),
+        'gif': path.join(directory, name + '.gif'),
+        'images': path.join(directory, name) + '/',
+    }
+    frames = [synthetic_frame(width, height, i) for i in range(length)]
+    video = cv2.VideoWriter(inputs['mp4'], cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
+    for frame in frames:
+        video.write(frame)
+    video.release()
+    write_gif((cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames), inputs['gif'], 30)
+    makedirs(inputs['images'], exist_ok=True)
+    for i, frame in enumerate(frames):
+        cv2.imwrite(path.join(inputs['images'], '{:05d}.jpg'.format(i)), frame)
+    return inputs
+
+
+def generate_overlay(directory: str) -> str:
+    """Create a half transparent overlay image
+
+    Return:
+        - path of the .png image
+    """
+    overlay = zeros((200, 300, 4), dtype=uint8)
+    overlay[20:180, 20:280] = (0, 0, 255, 128)
+    overlay_path = path.join(directory, 'overlay.png')
+    cv2.imwrite(overlay_path, overlay)
+    return overlay_path
+
+
+def run_case(input_path: str, options: List[str], output_directory: str, repeat: int) -> dict:
+    """Run frame_manager.py on an input, repeat times, with --profile
+
+    Return:
+        - measures of the fastest run: frames, wall time (s), frames/s, MB/s of decoded frames
+          and peak memory (MB)
+    """
+    profile_path = path.join(output_directory, 'profile.json')
+    command = [executable, 'frame_manager.py', '-i', input_path, '-o', output_directory]
+    command += options + ['--profile', profile_path]
+    measures = []
+    for _ in range(repeat):
+        run(command, cwd=FRAME_MANAGER_DIRECTORY, stdout=DEVNULL, stderr=DEVNULL, check=True)
+        with open(profile_path) as profile_file:
+            profile = loads(profile_file.read())
+        stages = profile['stages']
+        decoded = stages.get('decode') or stages.get('imread')
+        measures.append(
+            {
+                'frames': decoded['frames'],
+                'wall': profile['wall'],
+                'fps': decoded['frames'] / profile['wall'],
+                'mb_per_s': decoded['bytes'] / 1024 ** 2 / profile['wall'],
+                'peak_rss_mb': (profile['peak_rss'] or 0) / 1024 ** 2,
+            }
+        )
+    return min(measures, key=lambda measure: measure['wall'])
+
+
+def benchmark_pipeline(
+    work_directory: str,
+    sizes: List[Tuple[int, int]],
+    lengths: List[int],
+    cases: List[str],
+    repeat: int,
+) -> Dict[str, dict]:
+    """Run every case on every generated input, for gif and mp4 outputs
+
+    Return:
+        - measures by name: input kind, size, length, case, output
+    """
+    overlay_path = generate_overlay(work_directory)
+    results = {}
+    for width, height in sizes:
+        for length in lengths:
+            inputs = generate_inputs(work_directory, width, height, length)
+            for kind, input_path in inputs.items():
+                for case in cases:
+                    for output, output_options in OUTPUTS.items():
+                        name = '{}_{}x{}_{}_{}_{}'.format(kind, width, height, length, case, output)
+                        options = [option.format(overlay=overlay_path) for option in CASES[case]]
+                        output_directory = path.join(work_directory, 'results')
+                        results[name] = run_case(
+                            input_path, options + output_options, output_directory, repeat
+                        )
+                        print(format_result(name, results[name]))
+    return results
+
+
+def format_result(name: str, result: dict, baseline: dict = None) -> str:
+    """Format the measures of a case, with the frames/s change if a baseline is given"""
+    line = '{:<42} {:9.1f} frames/s {:9.1f} MB/s {:8.1f} MB'.format(
+        name, result['fps'], result['mb_per_s'], result['peak_rss_mb']
+    )
+    if baseline is not None:
+        line += ' {:+7.1%}'.format(result['fps'] / baseline['fps'] - 1)
+    return line
+
+
+def compare(
+    results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float
+) -> Tuple[List[str], List[str]]:
+    """Compare frames/s to a baseline
+
+    Args:
+        - results: measures by case name
+        - baseline: measures by case name of the baseline
+        - tolerance: slowdown allowed, 0.1 for 10%
+    Return:
+        - report lines of the cases in both, names of the cases slower than the tolerance
+    """
+    lines, regressions = [], []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        lines.append(format_result(name, result, baseline[name]))
+        if result['fps'] < baseline[name]['fps'] * (1 - tolerance):
+            regressions.append(name)
+    return lines, regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        required=False,
+        default=3,
+        type=int,
+        help="Number of runs of each measure, the best (or median for --startup) is reported "
+        "(default is 3).",
+    )
+    parser.add_argument(
+        "--startup",
+        required=False,
+        action="store_true",
+        help="Measure the startup time instead of the frame pipeline.",
+    )
+    parser.add_argument(
+        "--sizes",
+        required=False,
+        default="320x240,1280x720",
+        type=str,
+        help="Sizes of the generated inputs, format: widthxheight,widthxheight",
+    )
+    parser.add_argument(
+        "--lengths",
+        required=False,
+        default="60",
+        type=str,
+        help="Number of frames of the generated inputs, format: n1,n2",
+    )
+    parser.add_argument(
+        "--cases",
+        required=False,
+        default=','.join(CASES),
+        type=str,
+        help="Cases to run, among: " + ', '.join(CASES),
+    )
+    parser.add_argument(
+        "--save", required=False, default=None, type=str, help="Save the results to a .json file."
+    )
+    parser.add_argument(
+        "--baseline",
+        required=False,
+        default=None,
+        type=str,
+        help="Compare the results to a .json file saved with --save.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        required=False,
+        default=0.1,
+        type=float,
+        help="Slowdown allowed before a case is reported as a regression (default is 0.1).",
+    )
+    parser.add_argument(
+        "--work_dir",
+        required=False,
+        default=None,
+        type=str,
+        help="Directory of the generated inputs and outputs (default is a temporary one).",
+    )
+    args = parser.parse_args()
+
+    if args.startup:
+        for line in benchmark_startup(args.repeat):
+            print(line)
+        return
+
+    sizes = [tuple(int(el) for el in size.split('x')) for size in args.sizes.split(',')]
+    lengths = [int(el) for el in args.lengths.split(',')]
+    work_directory = args.work_dir or mkdtemp()
+    makedirs(work_directory, exist_ok=True)
+    try:
+        results = benchmark_pipeline(
+            work_directory, sizes, lengths, args.cases.split(','), args.repeat
+        )
+    finally:
+        if args.work_dir is None:
+            rmtree(work_directory)
+
+    if args.save is not None:
+        with open(args.save, 'w') as results_file:
+            results_file.write(dumps(results, indent=1))
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = loads(baseline_file.read())
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("Compared to " + args.baseline + ":")
+        for line in lines:
+            print(line)
+        if regressions:
+            print("Slower than the baseline: " + ', '.join(regressions))
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,134 +12,1966 @@ Example:
     python gif_maker.py -i img_path/
     will create a gif at 30 fps as result.gif in the img_path directory
 
-    - extract images from .mp4 video
+    - create a gif from a .mp4 video
     python gif_maker.py -i video.mp4 -p 4
-    will extract all the video frames to tmp_images/ folder and create a gif
+    will decode the video frames in memory and create a gif
     at 30 fps with 1/4 of frames
 
     - extract images from .gif file
     python gif_maker.py -i mygif.gif -r 0.5 -n resized_gif.gif -k -f 10
     will extract all the gif frames from mygif.gif to tmp_images/ folder
     will create a new gif resized_gif.gif with resolution divided by 2, at 10 fps
-    will not remove the tmp_images/ folder
 """
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from csv import DictReader
+from functools import lru_cache
 from glob import glob
-from math import cos, radians, sin
-from os import makedirs, path, remove, rmdir
-from sys import stdout, maxsize
+from hashlib import sha1
+from itertools import chain, repeat
+from json import dumps, loads
+from math import ceil, cos, radians, sin
+from os import SEEK_END, fdopen, listdir, makedirs, path, remove, replace, utime
+from queue import Empty, Full, Queue
+from shutil import rmtree
+from struct import pack
+from sys import exit, maxsize, modules, platform
+from tempfile import mkdtemp, mkstemp
+from threading import Event, Lock, Thread
+from time import perf_counter, thread_time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import cv2
-from imageio import get_writer
-from numpy import array, ndarray
-from PIL import Image
+from numpy import (
+    argmax,
+    array,
+    ascontiguousarray,
+    bincount,
+    concatenate,
+    copyto,
+    empty,
+    flatnonzero,
+    float32,
+    indices,
+    load,
+    multiply,
+    ndarray,
+    stack,
+    uint8,
+    uint16,
+)
 from tqdm import tqdm
 
+# PIL and concurrent.futures are imported by the functions using them:
+# runs which do not read/write gifs or use workers do not pay their import time
+if TYPE_CHECKING:
+    from PIL import Image
 
-def overlap_two_images(img1: Image, img2: Image) -> array:
+
+class Profiler:
+    """Cumulative wall time, CPU time, frames and bytes of each stage of the pipeline
+
+    Stages run in several threads: the CPU time of a stage is the CPU time of the thread
+    running it (work done in gif encoding processes is only seen as wall time). Bytes are the
+    size of the frames produced by the stage (given to the stage for encode and save).
+    Disabled by default: stages then cost one test.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.start = perf_counter()
+        self.lock = Lock()
+
+    def enable(self) -> None:
+        """Start profiling, from zero"""
+        self.enabled = True
+        self.stages = {}
+        self.start = perf_counter()
+
+    def add(self, name: str, wall: float, cpu: float, frames: int = 1, nbytes: int = 0) -> None:
+        """Add a measure to a stage"""
+        with self.lock:
+            stage = self.stages.setdefault(
+                name, {'frames': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0}
+            )
+            stage['frames'] += frames
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['bytes'] += nbytes
+
+    def time(self, name: str, function: Callable, *args, nbytes: Optional[int] = None):
+        """Call a function and add the measure to a stage
+
+        Args:
+            - name: name of the stage
+            - function: function to call with args
+            - nbytes: bytes processed (None for the size of the returned frame)
+        Return:
+            - result of the function
+        """
+        if not self.enabled:
+            return function(*args)
+        wall, cpu = perf_counter(), thread_time()
+        result = function(*args)
+        if nbytes is None:
+            nbytes = getattr(result, 'nbytes', 0)
+        self.add(name, perf_counter() - wall, thread_time() - cpu, 1, nbytes)
+        return result
+
+    def iterate(self, name: str, items: Iterable) -> Iterator:
+        """Pass items through, the time to get each item is added to a stage"""
+        if not self.enabled:
+            yield from items
+            return
+        items, end = iter(items), object()
+        while True:
+            wall, cpu = perf_counter(), thread_time()
+            item = next(items, end)
+            if item is end:
+                return
+            frame = item[1] if isinstance(item, tuple) else item
+            nbytes = getattr(frame, 'nbytes', 0)
+            self.add(name, perf_counter() - wall, thread_time() - cpu, 1, nbytes)
+            yield item
+
+    def summary(self) -> dict:
+        """Stages, total wall time and peak resident memory (None if unknown) of the process"""
+        try:
+            from resource import RUSAGE_SELF, getrusage
+
+            # kilobytes on Linux, bytes on macOS
+            peak_rss = getrusage(RUSAGE_SELF).ru_maxrss
+            if platform.startswith('linux'):
+                peak_rss *= 1024
+        except ImportError:
+            peak_rss = None
+        with self.lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+        return {'wall': perf_counter() - self.start, 'peak_rss': peak_rss, 'stages': stages}
+
+    def table(self) -> str:
+        """Summary as a table"""
+        summary = self.summary()
+        lines = [
+            '{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+                'stage', 'frames', 'wall (s)', 'cpu (s)', 'MB', 'frames/s'
+            )
+        ]
+        for name, stage in summary['stages'].items():
+            lines.append(
+                '{:<10} {:>8} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.1f}'.format(
+                    name,
+                    stage['frames'],
+                    stage['wall'],
+                    stage['cpu'],
+                    stage['bytes'] / 1024 ** 2,
+                    stage['frames'] / stage['wall'] if stage['wall'] > 0 else 0.0,
+                )
+            )
+        lines.append('total wall time: {:.3f}s'.format(summary['wall']))
+        if summary['peak_rss'] is not None:
+            lines.append('peak RSS: {:.1f} MB'.format(summary['peak_rss'] / 1024 ** 2))
+        return '\n'.join(lines)
+
+
+profiler = Profiler()
+
+
+class ImageOverlay:
+    """Overlap an image on frames, blending in place with NumPy
+
+    The overlay is converted once, for each frame size, to premultiplied color and inverse
+    alpha planes. The result is the same as PIL's paste with the overlay alpha as mask.
+
+    Args:
+        - overlay: image to overlap, pasted at the top left corner of the frames
+    """
+
+    def __init__(self, overlay: 'Image.Image'):
+        self.color = array(overlay.convert('RGB')).astype(uint16)
+        self.alpha = array(overlay.convert('RGBA'))[..., 3:].astype(uint16)
+        self.planes = {}
+
+    def get_planes(
+        self, height: int, width: int, rgb: bool
+    ) -> Optional[Tuple[int, int, ndarray, ndarray]]:
+        """Get the premultiplied color and inverse alpha planes for a frame size
+
+        Planes are cropped to the area where the overlay is not fully transparent.
+
+        Return:
+            - top, left, premultiplied color plane, inverse alpha plane
+        """
+        key = (height, width, rgb)
+        if key not in self.planes:
+            alpha = self.alpha[:height, :width]
+            color = self.color[:height, :width]
+            if not rgb:
+                color = color[..., ::-1]
+            rows = flatnonzero(alpha.any(axis=(1, 2)))
+            cols = flatnonzero(alpha.any(axis=(0, 2)))
+            if len(rows) == 0:
+                self.planes[key] = None
+                return None
+            area = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            alpha, color = alpha[area], color[area]
+            # + 128: rounding of the division by 255
+            premultiplied = color * alpha + 128
+            inverse_alpha = (255 - alpha).repeat(3, axis=2)
+            self.planes[key] = (rows[0], cols[0], premultiplied, inverse_alpha)
+        return self.planes[key]
+
+    def __call__(self, frame: ndarray, rgb: bool = True) -> ndarray:
+        """Overlap the image on a frame
+
+        Args:
+            - frame: frame to modify in place
+            - rgb: True if the frame is RGB, False if it is BGR
+        Return:
+            - the modified frame
+        """
+        planes = self.get_planes(frame.shape[0], frame.shape[1], rgb)
+        if planes is None:
+            return frame
+        top, left, premultiplied, inverse_alpha = planes
+        h, w = inverse_alpha.shape[:2]
+        area = frame[top : top + h, left : left + w]
+        blended = multiply(area, inverse_alpha, dtype=uint16)
+        blended += premultiplied
+        # division by 255 as done by PIL
+        blended += blended >> 8
+        blended >>= 8
+        copyto(area, blended, casting='unsafe')
+        return frame
+
+
+def overlap_two_images(img1: 'Image.Image', img2: 'Image.Image') -> array:
+    """
+    Function to overlap segmentation map with image
+
+    Args:
+        - img1: first image
+        - img2: second image
+    Return:
+        - overlap between the two input images
+    """
+    return ImageOverlay(img2)(array(img1.convert('RGB')))
+
+
+def ordered_map(
+    function: Callable, items: Iterable[tuple], workers: int = 1, window: int = 1
+) -> Iterator:
+    """Lazily apply a function to items with a pool of threads, results keep the items order
+
+    Args:
+        - function: function called with the unpacked items
+        - items: iterator over tuples of arguments
+        - workers: number of threads (<= 1 to call the function in the current thread)
+        - window: maximum number of items being processed at the same time
+    Return:
+        - iterator over the results
+    """
+    if workers <= 1:
+        for item in items:
+            yield function(*item)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # cv2 releases the GIL, threads avoid pickling each frame to a process
+    window = max(window, workers)
+    with ThreadPoolExecutor(workers) as pool:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(pool.submit(function, *item))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class FrameRateSampler:
+    """Select the source frames nearest to the timestamps of an output at a target fps
+
+    Output timestamps start at the first frame given to the sampler. A source frame is kept
+    once for each output timestamp nearer to it than to the previous and next frames: frames
+    are dropped if the target fps is lower than the source fps, repeated if it is higher.
+
+    Args:
+        - target_fps: fps of the output
+    """
+
+    def __init__(self, target_fps: float):
+        self.period = 1000 / target_fps
+        self.start = None
+        self.low = 0.0
+
+    def count(self, timestamp: float, next_timestamp: float) -> int:
+        """Get the number of output timestamps for which a source frame is the nearest
+
+        Args:
+            - timestamp: time of the frame in ms
+            - next_timestamp: time of the next frame in ms
+        Return:
+            - number of times to keep the frame (0 to drop it)
+        """
+        if self.start is None:
+            self.start = timestamp
+        # the frame is the nearest from the middle with the previous frame to the middle with
+        # the next one, reusing the previous bound counts each output timestamp exactly once
+        low = self.low
+        self.low = max((timestamp + next_timestamp) / 2 - self.start, low)
+        return ceil(self.low / self.period) - ceil(low / self.period)
+
+
+def read_gif(
+    gif_path: str,
+    skip: int,
+    start_idx: int,
+    end_idx: int,
+    rgb: bool = False,
+    target_fps: Optional[float] = None,
+) -> Iterator[Tuple[int, ndarray]]:
+    """Read frames from a .gif file without writing them to disk
+
+    Frames are decoded in one forward pass which stops after end_idx.
+
+    Args:
+        - gif_path: input gif to read
+        - skip: reduce the number of images: keep 1 frame/skip
+        - start_idx: start index of the frames to keep
+        - end_idx: end index of the frames to keep
+        - rgb: True to get RGB frames, False for BGR frames
+        - target_fps: keep the frames nearest to the timestamps of an output at this fps,
+          given by the frame durations, instead of 1 frame/skip (None to disable)
+    Return:
+        - iterator over (frame index, frame)
+    """
+    from PIL import Image, ImageSequence
+
+    sampler = FrameRateSampler(target_fps) if target_fps is not None else None
+    timestamp = 0
+    gif_object = Image.open(gif_path)
+    # single forward pass: n_frames would scan the whole file first
+    for i, frame in enumerate(ImageSequence.Iterator(gif_object)):
+        if i > end_idx:
+            break
+        # frames without duration are shown 100 ms by most viewers
+        next_timestamp = timestamp + (frame.info.get('duration') or 100)
+        if i >= start_idx:
+            if sampler is None:
+                count = int(i % skip == 0)
+            else:
+                count = sampler.count(timestamp, next_timestamp)
+            if count > 0:
+                rgb_frame = array(frame.convert('RGB'))
+                if not rgb:
+                    rgb_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGR)
+                for _ in range(count):
+                    yield i, rgb_frame
+        timestamp = next_timestamp
+
+
+def read_video(
+    video_path: str,
+    skip: int,
+    start_idx: int,
+    end_idx: int,
+    target_fps: Optional[float] = None,
+) -> Iterator[Tuple[int, ndarray]]:
+    """Read frames from a .mp4 file without writing them to disk
+
+    The video is seeked to start_idx, skipped frames are only grabbed (not decoded)
+    and decoding stops after end_idx.
+
+    Args:
+        - video_path: input video to read
+        - skip: reduce the number of images: keep 1 frame/skip.
+        - start_idx: start index of the frames to keep
+        - end_idx: end index of the frames to keep
+        - target_fps: keep the frames nearest to the timestamps of an output at this fps,
+          given by the video timestamps, instead of 1 frame/skip (None to disable)
+    Return:
+        - iterator over (frame index, BGR frame)
+    """
+    video_capture = cv2.VideoCapture(video_path)
+    sampler, frame_duration = None, 0.0
+    if target_fps is not None:
+        source_fps = video_capture.get(cv2.CAP_PROP_FPS)
+        if source_fps <= 0:
+            raise Exception("Unknown fps of " + video_path)
+        sampler, frame_duration = FrameRateSampler(target_fps), 1000 / source_fps
+    i = 0
+    if start_idx > 0:
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_idx)
+        i = int(video_capture.get(cv2.CAP_PROP_POS_FRAMES))
+        if i > start_idx:
+            # the backend could not seek accurately: restart from the beginning
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            i = 0
+    while i <= end_idx:
+        if not video_capture.grab():
+            break
+        if i >= start_idx:
+            if sampler is None:
+                count = int(i % skip == 0)
+            else:
+                # timestamp of the grabbed frame
+                timestamp = video_capture.get(cv2.CAP_PROP_POS_MSEC)
+                count = sampler.count(timestamp, timestamp + frame_duration)
+            if count > 0:
+                success, image = video_capture.retrieve()
+                if not success:
+                    break
+                for _ in range(count):
+                    yield i, image
+        i += 1
+    video_capture.release()
+
+
+def get_reduction(resize_fact: float) -> int:
+    """Largest JPEG decoding reduction keeping images at or above resize_fact
+
+    Args:
+        - resize_fact: resize factor that will be applied to the images
+    Return:
+        - 1, 2, 4 or 8
+    """
+    reduction = 1
+    while reduction < 8 and resize_fact * reduction * 2 <= 1:
+        reduction *= 2
+    return reduction
+
+
+def get_jpeg_size(image_path: str) -> Optional[Tuple[int, int]]:
+    """Read the size of a JPEG image from its header, without decoding it
+
+    Args:
+        - image_path: path of the image
+    Return:
+        - width, height as decoded by cv2, with the EXIF orientation (None if not a JPEG image)
+    """
+    with open(image_path, 'rb') as image_file:
+        if image_file.read(3) != b'\xff\xd8\xff':
+            return None
+
+    from PIL import Image
+
+    try:
+        with Image.open(image_path) as image:
+            if image.format != 'JPEG':
+                return None
+            width, height = image.size
+            # cv2 applies the EXIF orientation
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                width, height = height, width
+    except OSError:
+        # not identified by Pillow (UnidentifiedImageError is an OSError)
+        return None
+    return width, height
+
+
+def read_image(image_path: str, resize_fact: float = 1.0, resize_backend: str = 'auto') -> ndarray:
+    """Read an image, JPEG images are decoded directly at a reduced resolution if downscaled
+
+    Args:
+        - image_path: path of the image
+        - resize_fact: multiply image resolution by given number
+        - resize_backend: downscale backend, one of RESIZE_BACKENDS
+    Return:
+        - BGR image, resized
+    """
+    if resize_fact == 1.0:
+        return profiler.time('imread', cv2.imread, image_path)
+
+    # only JPEG images have a reduced resolution decoding, other formats are read by cv2 only
+    size = get_jpeg_size(image_path)
+    if size is None:
+        image = profiler.time('imread', cv2.imread, image_path)
+        return resize_image(image, resize_fact, resize_backend)
+    width, height = size
+    target_size = (int(width * resize_fact), int(height * resize_fact))
+
+    flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }[get_reduction(resize_fact)]
+    image = profiler.time('imread', cv2.imread, image_path, flags)
+    if (image.shape[1], image.shape[0]) != target_size:
+        image = resize_to(image, target_size, resize_backend)
+    return image
+
+
+def read_images(
+    images_list_path: List[str],
+    workers: int = 1,
+    read_ahead: int = 1,
+    resize_fact: float = 1.0,
+    resize_backend: str = 'auto',
+) -> Iterator[Tuple[int, ndarray]]:
+    """Read images from a list of paths, in order, with a pool of threads
+
+    Args:
+        - images_list_path: paths of the images to read
+        - workers: number of threads decoding images
+        - read_ahead: maximum number of images decoded in advance
+        - resize_fact: multiply image resolution by given number
+        - resize_backend: downscale backend, one of RESIZE_BACKENDS
+    Return:
+        - iterator over (image index, BGR image)
+    """
+
+    def read(i: int, image_path: str) -> Tuple[int, ndarray]:
+        return i, read_image(image_path, resize_fact, resize_backend)
+
+    return ordered_map(read, enumerate(images_list_path), workers, read_ahead)
+
+
+def save_frames(
+    frames: Iterable[Tuple[int, ndarray]], output_path: str, rgb: bool = False
+) -> Iterator[Tuple[int, ndarray]]:
+    """Save frames to the output_path folder (.png images) while passing them through
+
+    Args:
+        - frames: iterator over (frame index, frame)
+        - output_path: path for output .png images
+        - rgb: True if frames are RGB, False if BGR
+    Return:
+        - iterator over the same (frame index, frame)
+    """
+    for i, frame in frames:
+        bgr_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) if rgb else frame
+        image_path = output_path + "frame_{0:08d}.png".format(i)
+        profiler.time('save', cv2.imwrite, image_path, bgr_frame, nbytes=frame.nbytes)
+        yield i, frame
+
+
+def extract_gif(result_path: str, output_path: str, skip: int, start_idx: int, end_idx: int) -> int:
+    """Extract images from a .gif file to the output_path folder (.png images)
+
+    Args:
+        - result_path: input gif to extract
+        - output_path: path for output .png images
+        - skip: reduce the number of images: keep 1 frame/skip
+        - start_idx: start index to save images
+        - end_idx: end index to save images
+    Return:
+        - number of frames extracted
+    """
+    frames = profiler.iterate('decode', read_gif(result_path, skip, start_idx, end_idx))
+    frames = save_frames(frames, output_path)
+    return sum(1 for _ in frames)
+
+
+def extract_video(
+    video_path: str, output_path: str, skip: int, start_idx: int, end_idx: int
+) -> int:
+    """Extract images from a .mp4 file to the output_path folder (.png images)
+
+    Args:
+        - result_path: input video to extract
+        - output_path: path for output .png images
+        - skip: reduce the number of images: keep 1 frame/skip.
+        - start_idx: start index to save images
+        - end_idx: end index to save images
+    Return:
+        - number of frames extracted
+    """
+    frames = profiler.iterate('decode', read_video(video_path, skip, start_idx, end_idx))
+    frames = save_frames(frames, output_path)
+    return sum(1 for _ in frames)
+
+
+RESIZE_BACKENDS = ['auto', 'linear', 'area', 'pyramid', 'halving', 'pil']
+RESIZE_CHOICES_PATH = path.join(path.expanduser('~'), '.cache', 'frame_manager', 'resize.json')
+
+
+def resize_with(image: ndarray, size: Tuple[int, int], backend: str) -> ndarray:
+    """Resize an image with one backend
+
+    Args:
+        - image: input image to resize
+        - size: width, height of the result
+        - backend: 'linear' (cv2 INTER_LINEAR), 'area' (cv2 INTER_AREA), 'pyramid' (halve
+          with cv2.pyrDown, then INTER_AREA), 'halving' (halve with 2x2 averages, then
+          INTER_AREA) or 'pil' (Pillow box filter with reduce)
+    Return:
+        - resized image
+    """
+    if backend in ['pyramid', 'halving']:
+        while image.shape[1] >= 2 * size[0] and image.shape[0] >= 2 * size[1]:
+            if backend == 'pyramid':
+                image = cv2.pyrDown(image)
+            else:
+                # INTER_AREA has a fast path for an exact half size
+                half_size = (image.shape[1] // 2, image.shape[0] // 2)
+                image = cv2.resize(image, half_size, interpolation=cv2.INTER_AREA)
+        if (image.shape[1], image.shape[0]) == size:
+            return image
+        backend = 'area'
+    if backend == 'pil':
+        from PIL import Image
+
+        resized = Image.fromarray(image).resize(size, Image.Resampling.BOX, reducing_gap=2.0)
+        return array(resized)
+    interpolation = cv2.INTER_AREA if backend == 'area' else cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+class ResizeChooser:
+    """Choose the fastest downscale backend for each input and output size
+
+    The candidates depend on the scale factor, each one is timed on the first image of a size
+    and the choice is remembered in a json file, for the next runs.
+
+    Args:
+        - choices_path: json file remembering the choices (None to keep them in memory only)
+    """
+
+    def __init__(self, choices_path: Optional[str] = RESIZE_CHOICES_PATH):
+        self.choices_path = choices_path
+        self.choices = None
+        self.lock = Lock()
+
+    @staticmethod
+    def candidates(factor: float) -> List[str]:
+        """Get the backends giving a good quality for a downscale factor"""
+        if factor < 0.5:
+            # linear interpolation skips source pixels: aliasing
+            candidates = ['area', 'pyramid', 'halving']
+            # Pillow is only timed if already imported (gifs, overlays), not imported for it
+            if 'PIL.Image' in modules:
+                candidates.append('pil')
+            return candidates
+        return ['linear', 'area']
+
+    def load(self) -> None:
+        self.choices = {}
+        if self.choices_path is not None and path.isfile(self.choices_path):
+            try:
+                with open(self.choices_path) as choices_file:
+                    self.choices = dict(loads(choices_file.read()))
+            except (ValueError, TypeError, OSError):
+                # unreadable file: the backends are timed again
+                self.choices = {}
+
+    def save(self) -> None:
+        if self.choices_path is None:
+            return
+        tmp_path = None
+        try:
+            directory = path.dirname(self.choices_path)
+            makedirs(directory, exist_ok=True)
+            # runs in parallel never see a partly written file
+            fd, tmp_path = mkstemp(prefix='tmp_', suffix='.json', dir=directory)
+            with fdopen(fd, 'w') as choices_file:
+                choices_file.write(dumps(self.choices, indent=1, sort_keys=True))
+            replace(tmp_path, self.choices_path)
+        except OSError:
+            # the choice is only kept for this run
+            if tmp_path is not None and path.isfile(tmp_path):
+                remove(tmp_path)
+
+    def __call__(self, image: ndarray, size: Tuple[int, int]) -> str:
+        """Get the backend to downscale images like this one to the given size
+
+        Args:
+            - image: first image of this size, used for the benchmark
+            - size: width, height of the result
+        Return:
+            - name of the backend
+        """
+        key = '{}x{}x{}:{}x{}'.format(*image.shape[1::-1], image[0, 0].size, *size)
+        with self.lock:
+            if self.choices is None:
+                self.load()
+            if key not in self.choices:
+                durations = {}
+                for backend in self.candidates(size[0] / image.shape[1]):
+                    durations[backend] = maxsize
+                    for _ in range(3):
+                        start = perf_counter()
+                        resize_with(image, size, backend)
+                        durations[backend] = min(durations[backend], perf_counter() - start)
+                self.choices[key] = min(durations, key=durations.get)
+                self.save()
+            return self.choices[key]
+
+
+choose_resize_backend = ResizeChooser()
+
+
+def resize_to(image: ndarray, size: Tuple[int, int], backend: str = 'auto') -> ndarray:
+    """Resize an image to a size, downscales use the given backend (upscales are linear)
+
+    Args:
+        - image: input image to resize
+        - size: width, height of the result
+        - backend: one of RESIZE_BACKENDS, 'auto' chooses the fastest on this host
+    Return:
+        - resized image
+    """
+    if size[0] >= image.shape[1] and size[1] >= image.shape[0]:
+        backend = 'linear'
+    elif backend == 'auto':
+        backend = choose_resize_backend(image, size)
+    return profiler.time('resize', resize_with, image, size, backend)
+
+
+def resize_image(image: ndarray, resize_fact: float, backend: str = 'auto') -> ndarray:
+    """Multiply image resolution by given number
+
+    Args:
+        - image: input image to resize
+        - resize_fact: resize factor
+        - backend: downscale backend, one of RESIZE_BACKENDS
+    Return:
+        - resized image
+    """
+    size = (int(image.shape[1] * resize_fact), int(image.shape[0] * resize_fact))
+    return resize_to(image, size, backend)
+
+
+class ImageRotator:
+    """Rotate images of a given size, the rotation matrix and output size are computed once
+
+    Args:
+        - width: width of the images to rotate
+        - height: height of the images to rotate
+        - angle_deg: angle in degrees
+    """
+
+    def __init__(self, width: int, height: int, angle_deg: float):
+        img_c = (width / 2, height / 2)
+
+        rot = cv2.getRotationMatrix2D(img_c, angle_deg, 1)
+
+        rad = radians(angle_deg)
+        sinus = sin(rad)
+        cosinus = cos(rad)
+        b_w = int((height * abs(sinus)) + (width * abs(cosinus)))
+        b_h = int((height * abs(cosinus)) + (width * abs(sinus)))
+
+        rot[0, 2] += (b_w / 2) - img_c[0]
+        rot[1, 2] += (b_h / 2) - img_c[1]
+
+        self.matrix = rot
+        self.size = (b_w, b_h)
+
+    def __call__(self, image: ndarray, dst: Optional[ndarray] = None) -> ndarray:
+        """Rotate one image
+
+        Args:
+            - image: input image to rotate
+            - dst: optional preallocated output image of shape (b_h, b_w, channels)
+        Return:
+            - rotated image
+        """
+        return cv2.warpAffine(image, self.matrix, self.size, dst=dst, flags=cv2.INTER_LINEAR)
+
+
+def rotate_image(image: ndarray, angle_deg: float) -> ndarray:
+    """Rotate an image, the output is enlarged to contain the whole rotated image
+
+    Args:
+        - image: input image to rotate
+        - angle_deg: angle in degrees
+    Return:
+        - rotated image
+    """
+    h, w = image.shape[:2]
+    return ImageRotator(w, h, angle_deg)(image)
+
+
+class FrameWarp:
+    """Resize, rotate and pad images of a given size with a single warpAffine
+
+    Scale, rotation and padding translation are combined in one affine matrix, the padding
+    color is used as border value so the final canvas is produced in one pass.
+
+    Args:
+        - width: width of the images to warp
+        - height: height of the images to warp
+        - resize_fact: multiply image resolution by given number
+        - angle_deg: angle in degrees
+        - padding: top, bottom, left, right
+        - border_value: color of the padding
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        resize_fact: float = 1.0,
+        angle_deg: float = 0.0,
+        padding: Tuple[int, int, int, int] = (0, 0, 0, 0),
+        border_value: Tuple[int, int, int] = (0, 0, 0),
+    ):
+        new_width, new_height = int(width * resize_fact), int(height * resize_fact)
+        scale_x, scale_y = new_width / width, new_height / height
+        # same pixel center convention as cv2.resize
+        scale = array(
+            [
+                [scale_x, 0, 0.5 * scale_x - 0.5],
+                [0, scale_y, 0.5 * scale_y - 0.5],
+                [0, 0, 1],
+            ]
+        )
+        rotator = ImageRotator(new_width, new_height, angle_deg)
+        top, bottom, left, right = padding
+
+        self.matrix = rotator.matrix @ scale
+        self.matrix[0, 2] += left
+        self.matrix[1, 2] += top
+        self.size = (rotator.size[0] + left + right, rotator.size[1] + top + bottom)
+        self.border_value = border_value
+
+    def __call__(self, image: ndarray, dst: Optional[ndarray] = None) -> ndarray:
+        """Warp one image
+
+        Args:
+            - image: input image
+            - dst: optional preallocated output image
+        Return:
+            - resized, rotated and padded image
+        """
+        return cv2.warpAffine(
+            image,
+            self.matrix,
+            self.size,
+            dst=dst,
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=self.border_value,
+        )
+
+
+class FrameTransform:
+    """Resize, overlap, rotate and pad frames, always with the same parameters
+
+    When rotating, rotation, constant padding and upscaling are fused in a single FrameWarp.
+
+    Args:
+        - resize_fact: multiply image resolution by given number
+        - rotate_angle: angle in degrees to rotate image
+        - overlay: image to overlap with the frames (None to disable)
+        - padding: top, bottom, left, right, boderType, r, g, b (None to disable)
+        - overlap_range: start and end (excluded) index of the frames to overlap
+        - input_rgb: True if input frames are RGB, False if BGR
+        - output_rgb: True to output RGB frames, False for BGR
+        - resize_backend: downscale backend, one of RESIZE_BACKENDS
+    """
+
+    def __init__(
+        self,
+        resize_fact: float = 1.0,
+        rotate_angle: float = 0.0,
+        overlay: Optional[ImageOverlay] = None,
+        padding: Optional[Tuple[int, ...]] = None,
+        overlap_range: Tuple[int, int] = (0, maxsize),
+        input_rgb: bool = False,
+        output_rgb: bool = True,
+        resize_backend: str = 'auto',
+    ):
+        self.resize_fact = resize_fact
+        self.rotate_angle = rotate_angle
+        self.overlay = overlay
+        self.padding = padding
+        self.overlap_range = overlap_range
+        self.input_rgb = input_rgb
+        self.output_rgb = output_rgb
+        self.resize_backend = resize_backend
+        self.warps = {}
+
+    def get_warp(self, image: ndarray, resize_fact: float, pad: bool, rgb: bool) -> FrameWarp:
+        """Get the warp for the size of the given image, created on first use"""
+        h, w = image.shape[:2]
+        key = (w, h, resize_fact, pad, rgb)
+        if key not in self.warps:
+            padding, border_value = (0, 0, 0, 0), (0, 0, 0)
+            if pad:
+                top, bottom, left, right, _, r, g, b = self.padding
+                padding = (top, bottom, left, right)
+                border_value = (r, g, b) if rgb else (b, g, r)
+            self.warps[key] = FrameWarp(
+                w, h, resize_fact, self.rotate_angle, padding, border_value
+            )
+        return self.warps[key]
+
+    def __call__(self, index: int, img: ndarray) -> ndarray:
+        """Apply the transformation to one frame
+
+        Args:
+            - index: position of the frame in the sequence
+            - img: frame, RGB if input_rgb else BGR
+        Return:
+            - transformed frame, RGB if output_rgb else BGR
+        """
+        resize_fact = self.resize_fact
+        rgb = self.input_rgb
+        start, end = self.overlap_range
+        if self.overlay is not None and start <= index < end:
+            # the overlap is done between resize and rotation, on a copy of the frame
+            if resize_fact != 1.0:
+                img = resize_image(img, resize_fact, self.resize_backend)
+            else:
+                img = img.copy()
+            img = profiler.time('overlap', self.overlay, img, rgb)
+            resize_fact = 1.0
+
+        pad_in_warp = False
+        if self.rotate_angle != 0.0:
+            # warpAffine reads the source in rotated order, which is slower than cv2.resize
+            # on large sources: only upscaling is fused, downscaling is done beforehand
+            if resize_fact < 1.0:
+                img = resize_image(img, resize_fact, self.resize_backend)
+                resize_fact = 1.0
+            pad_in_warp = self.padding is not None and self.padding[4] == cv2.BORDER_CONSTANT
+            img = profiler.time('rotate', self.get_warp(img, resize_fact, pad_in_warp, rgb), img)
+        elif resize_fact != 1.0:
+            img = resize_image(img, resize_fact, self.resize_backend)
+
+        if self.padding is not None and not pad_in_warp:
+            top, bottom, left, right, boderType, r, g, b = self.padding
+            value = [r, g, b] if rgb else [b, g, r]
+            img = profiler.time(
+                'padding',
+                lambda: cv2.copyMakeBorder(img, top, bottom, left, right, boderType, value=value),
+            )
+
+        # the only color conversion of the pipeline, if the sink needs another channel order
+        if rgb != self.output_rgb:
+            img = profiler.time('convert', cv2.cvtColor, img, cv2.COLOR_BGR2RGB)
+        return img
+
+
+class FrameDeduplicator:
+    """Drop the frames nearly identical to the previous kept frame, before transforming them
+
+    Frames are compared on tiny copies with the mean absolute difference. A dropped frame is
+    replaced, after the transformation, by the previous transformed frame: gif frames are
+    merged into a longer one and the mp4 timing is kept.
+
+    Args:
+        - threshold: maximum mean absolute difference (0 to 255) of a dropped frame
+        - size: width and height of the compared copies
+        - boundaries: positions where the transformation changes (overlap range), the frames
+          at these positions are never dropped
+    """
+
+    def __init__(self, threshold: float, size: int = 32, boundaries: Iterable[int] = ()):
+        self.threshold = threshold
+        self.size = size
+        self.boundaries = set(boundaries)
+        self.reference = None
+        self.kept = 0
+        self.dropped = 0
+        self.compare_time = 0.0
+        self.transform_time = 0.0
+        self.lock = Lock()
+
+    def drop(
+        self, frames: Iterable[Tuple[int, ndarray]]
+    ) -> Iterator[Tuple[int, Optional[ndarray]]]:
+        """Replace the frames nearly identical to the previous kept frame by None
+
+        Args:
+            - frames: iterator over (frame index, frame)
+        Return:
+            - iterator over (frame index, frame or None)
+        """
+        for position, (i, frame) in enumerate(frames):
+            # the previous frame is transformed differently: it can't replace this one
+            if position in self.boundaries:
+                self.reference = None
+            start = perf_counter()
+            duplicate = profiler.time('dedup', self.is_duplicate, frame, nbytes=frame.nbytes)
+            self.compare_time += perf_counter() - start
+            if duplicate:
+                self.dropped += 1
+                yield i, None
+            else:
+                self.kept += 1
+                yield i, frame
+
+    def is_duplicate(self, frame: ndarray) -> bool:
+        """Compare a frame to the last kept frame, it becomes the last kept frame if different"""
+        small = cv2.resize(frame, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        if self.reference is not None:
+            if cv2.norm(small, self.reference, cv2.NORM_L1) / small.size <= self.threshold:
+                return True
+        # compared to the last kept frame: slow changes are not dropped forever
+        self.reference = small
+        return False
+
+    def transform(self, transform: Callable[[int, ndarray], ndarray]) -> Callable:
+        """Wrap a frame transformation to skip the dropped frames and time the others"""
+
+        def transform_kept(index: int, img: Optional[ndarray]) -> Optional[ndarray]:
+            if img is None:
+                return None
+            start = perf_counter()
+            img = transform(index, img)
+            with self.lock:
+                self.transform_time += perf_counter() - start
+            return img
+
+        return transform_kept
+
+    def fill(self, frames: Iterable[Optional[ndarray]]) -> Iterator[ndarray]:
+        """Replace the dropped frames by the previous transformed frame"""
+        previous = None
+        for frame in frames:
+            if frame is None:
+                frame = previous
+            previous = frame
+            yield frame
+
+    def report(self) -> str:
+        """Summary of the dropped frames and of the transformation time saved"""
+        saved = self.dropped * self.transform_time / max(self.kept, 1)
+        return (
+            "Dropped {}/{} duplicate frames, saved ~{:.2f}s of transformation "
+            "({:.2f}s comparing frames).".format(
+                self.dropped, self.kept + self.dropped, saved, self.compare_time
+            )
+        )
+
+
+def transform_frames(
+    frames: Iterable[Tuple[int, ndarray]],
+    transform: Callable[[int, ndarray], ndarray],
+    workers: int = 1,
+    window: int = 1,
+) -> Iterator[ndarray]:
+    """Lazily apply a transformation to a stream of frames, in order
+
+    Args:
+        - frames: iterator over (frame index, frame)
+        - transform: transformation to apply
+        - workers: number of threads transforming frames in parallel
+        - window: maximum number of frames being transformed at the same time
+    Return:
+        - iterator over the transformed frames
+    """
+    positions = ((i, img) for i, (_, img) in enumerate(frames))
+    return ordered_map(transform, positions, workers, window)
+
+
+def append_image(
+    frames: Iterable[ndarray], img_path: str, times: int, rgb: bool = True
+) -> Iterator[ndarray]:
+    """Pass frames through and add an image, resized to the last frame, at the end
+
+    Args:
+        - frames: iterator over frames
+        - img_path: path of the image to add
+        - times: number of times to add the image
+        - rgb: True if frames are RGB, False if BGR
+    Return:
+        - iterator over the frames followed by the added image
+    """
+    frame = None
+    for frame in frames:
+        yield frame
+    if frame is None:
+        return
+    # the same array is yielded each time, nothing is copied
+    yield from repeat(load_added_image(img_path, frame.shape, rgb), times)
+
+
+def load_added_image(img_path: str, shape: Tuple[int, ...], rgb: bool = True) -> ndarray:
+    """Read an image to add to the frames, resized to their shape
+
+    Args:
+        - img_path: path of the image to add
+        - shape: shape of the frames
+        - rgb: True if frames are RGB, False if BGR
+    Return:
+        - image
+    """
+    image = cv2.resize(cv2.imread(img_path), (shape[1], shape[0]))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if rgb else image
+
+
+class FrameSequence:
+    """Reorder and extend stored frames by index: frames are never decoded or transformed again
+
+    The sequence is a list of items: indices in the stored frames, or functions creating new
+    frames (added images, crossfades) called when the frames are written.
+
+    Operations, applied in order, in the format name[:parameters]:
+        - reverse: play the sequence backwards
+        - pingpong: play the sequence forwards then backwards (boomerang)
+        - repeat:N: play the sequence N times
+        - crossfade:N: blend the N last frames with the N first ones, for a seamless loop
+        - add:img_path:N: add an image, resized to the last frame, N times at the end
+
+    Args:
+        - frames: stored frames, shape (N, H, W, 3)
+        - operations: operations to apply
+        - rgb: True if frames are RGB, False if BGR
+    """
+
+    def __init__(self, frames: ndarray, operations: Iterable[str] = (), rgb: bool = True):
+        self.frames = frames
+        self.rgb = rgb
+        self.items = list(range(len(frames)))
+        for operation in operations:
+            self.apply(operation)
+
+    def get(self, item) -> ndarray:
+        """Get the frame of an item of the sequence"""
+        return self.frames[item] if isinstance(item, int) else item()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self) -> Iterator[ndarray]:
+        for item in self.items:
+            yield self.get(item)
+
+    def apply(self, operation: str) -> None:
+        """Apply an operation, in the format name[:parameters]"""
+        name, _, parameters = operation.partition(':')
+        if name == 'reverse':
+            self.items.reverse()
+        elif name == 'pingpong':
+            # the first and last frames are not shown twice in a row when looping
+            self.items += self.items[-2:0:-1]
+        elif name == 'repeat':
+            self.items *= int(parameters)
+        elif name == 'crossfade':
+            self.crossfade(int(parameters))
+        elif name == 'add':
+            img_path, times = parameters.rsplit(':', 1)
+            self.add_image(img_path, int(times))
+        else:
+            raise Exception("Unknown sequence operation: " + operation)
+
+    def crossfade(self, length: int) -> None:
+        """Blend the last frames with the first ones, the first ones are removed
+
+        The last frame of the sequence is then followed by its first frame without a cut.
+        """
+        length = min(length, len(self.items) // 2)
+        if length == 0:
+            return
+        head, tail = self.items[:length], self.items[-length:]
+
+        def blend(last, first, weight: float) -> Callable[[], ndarray]:
+            return lambda: cv2.addWeighted(self.get(last), 1 - weight, self.get(first), weight, 0)
+
+        blends = [
+            blend(last, first, (i + 1) / (length + 1))
+            for i, (last, first) in enumerate(zip(tail, head))
+        ]
+        self.items = self.items[length:-length] + blends
+
+    def add_image(self, img_path: str, times: int) -> None:
+        """Add an image at the end of the sequence, resized to the last frame"""
+        if len(self.items) == 0:
+            return
+        image = load_added_image(img_path, self.get(self.items[-1]).shape, self.rgb)
+        self.items += [lambda: image] * times
+
+
+def buffered(items: Iterable, size: int) -> Iterator:
+    """Consume an iterator from a background thread, keeping at most size items in advance
+
+    The thread is stopped, and the consumed iterator closed, when the returned iterator is
+    closed or fails.
+
+    Args:
+        - items: iterator to consume
+        - size: maximum number of items waiting to be used (<= 0 to disable the thread)
+    Return:
+        - iterator over the same items
+    """
+    if size <= 0:
+        yield from items
+        return
+
+    queue = Queue(maxsize=size)
+    end = object()
+    stop = Event()
+
+    def put(item) -> bool:
+        # the consumer can stop while the queue is full
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except BaseException as error:
+            put((end, error))
+        finally:
+            # stop the previous stages (decoders, threads) in this thread, which iterates them
+            if hasattr(items, 'close'):
+                items.close()
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        # release the waiting frames and unblock the producer
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+
+def color_cells(rgb: ndarray) -> ndarray:
+    """Get the index of the 8x8x8 cell of the RGB cube containing each color
+
+    Args:
+        - rgb: RGB colors, shape (..., 3)
+    Return:
+        - cell indices in [0, 32768), shape (...)
+    """
+    cells = rgb >> 3
+    index = cells[..., 0].astype(uint16)
+    index <<= 5
+    index |= cells[..., 1]
+    index <<= 5
+    index |= cells[..., 2]
+    return index
+
+
+def median_cut(pixels: ndarray, colors: int) -> ndarray:
+    """Median cut color quantization, pixels are first grouped by cell of the RGB cube
+
+    Args:
+        - pixels: RGB pixels of shape (M, 3)
+        - colors: maximum number of colors
+    Return:
+        - palette colors of shape (K, 3), K <= colors
+    """
+    index = color_cells(pixels)
+    counts = bincount(index, minlength=32768)
+    used = flatnonzero(counts)
+    # one point per used cell: the mean color of its pixels, weighted by their count
+    weights = counts[used]
+    points = stack([bincount(index, pixels[:, c], 32768)[used] for c in range(3)], axis=1)
+    points /= weights[:, None]
+    boxes = [(points, weights)]
+    ranges = [points.max(axis=0) - points.min(axis=0)]
+    while len(boxes) < colors:
+        # split the box with the largest color range at the weighted median of this range
+        i = int(argmax([box_range.max() for box_range in ranges]))
+        if ranges[i].max() == 0:
+            break
+        box_points, box_weights = boxes.pop(i)
+        order = box_points[:, ranges.pop(i).argmax()].argsort()
+        cumulated = box_weights[order].cumsum()
+        half = min(max(int(cumulated.searchsorted(cumulated[-1] / 2)), 1), len(order) - 1)
+        for part in (order[:half], order[half:]):
+            boxes.append((box_points[part], box_weights[part]))
+            ranges.append(box_points[part].max(axis=0) - box_points[part].min(axis=0))
+    colors = [box_weights @ box_points / box_weights.sum() for box_points, box_weights in boxes]
+    return array(colors).round().astype(uint8)
+
+
+class GifPalette:
+    """Global gif palette, frames are mapped to it with a 32x32x32 RGB lookup table
+
+    Args:
+        - colors: palette colors of shape (K, 3), K <= 255
+    """
+
+    def __init__(self, colors: ndarray):
+        self.colors = colors
+        # nearest palette color of the center of each cell of the RGB cube (see color_cells)
+        centers = (indices((32, 32, 32)).reshape(3, -1).T * 8 + 4).astype(float32)
+        points = colors.astype(float32)
+        distances = (points ** 2).sum(axis=1)[None, :] - 2 * centers @ points.T
+        self.lut = distances.argmin(axis=1).astype(uint8)
+
+    @classmethod
+    def from_frames(
+        cls, frames: ndarray, sample_count: int, sample_size: int = 128, colors: int = 255
+    ) -> 'GifPalette':
+        """Compute the palette from frames sampled with a stride over the whole sequence
+
+        Args:
+            - frames: RGB frames of shape (N, H, W, 3)
+            - sample_count: number of frames to sample
+            - sample_size: each sampled frame is reduced to sample_size x sample_size pixels
+            - colors: number of colors of the palette
+        Return:
+            - the palette
+        """
+        stride = max(len(frames) // sample_count, 1)
+        # nearest neighbor keeps the real colors of the frames
+        samples = [
+            cv2.resize(frame, (sample_size, sample_size), interpolation=cv2.INTER_NEAREST)
+            for frame in frames[::stride][:sample_count]
+        ]
+        return cls(median_cut(concatenate(samples).reshape(-1, 3), colors))
+
+    def map(self, frame: ndarray) -> ndarray:
+        """Get the palette index of each pixel
+
+        Args:
+            - frame: RGB frame
+        Return:
+            - palette indices, shape (H, W)
+        """
+        return self.lut.take(color_cells(frame))
+
+
+def encode_gif_frame(
+    frame_area: ndarray,
+    offset: Tuple[int, int],
+    duration: float,
+    unchanged: Optional[ndarray] = None,
+    palette: Optional[GifPalette] = None,
+    header: bool = False,
+) -> List[bytes]:
+    """Quantize and encode one gif frame
+
+    Args:
+        - frame_area: RGB area of the frame to encode
+        - offset: position of the area in the frame
+        - duration: duration of the frame in ms
+        - unchanged: mask of the pixels to leave transparent (None to keep all the pixels)
+        - palette: global palette (None to compute a palette for this frame)
+        - header: True to start the data with the gif header (first frame only)
+    Return:
+        - encoded data
+    """
+    from PIL import GifImagePlugin, Image
+
+    if palette is None:
+        # at most 255 colors: one index is left for transparency
+        image = Image.fromarray(frame_area)
+        image = image.convert("P", palette=Image.Palette.ADAPTIVE, colors=255)
+        image_colors = image.getpalette()
+        params = {} if header else {"include_color_table": True}
+    else:
+        image = Image.fromarray(palette.map(frame_area), "P")
+        image_colors = palette.colors.flatten().tolist()
+        params = {}
+
+    # the transparent color is the one after the colors of the palette
+    transparency = len(image_colors) // 3
+    if unchanged is not None and transparency < 256:
+        pixels = array(image)
+        pixels[unchanged] = transparency
+        image = Image.fromarray(pixels, "P")
+        params["transparency"] = transparency
+    image.putpalette(image_colors + [0, 0, 0])
+
+    # the frames have graphic control extensions (duration, transparency): GIF89a header
+    image.info["version"] = b"89a"
+    data = GifImagePlugin.getheader(image)[0] if header else []
+    return data + GifImagePlugin.getdata(image, offset, duration=duration, disposal=1, **params)
+
+
+class GifFrameOptimizer:
+    """Turn full frames into gif delta frames
+
+    Each frame is compared to the previous one: only the bounding box of the changed pixels
+    is kept, the unchanged pixels inside it can be left transparent, and identical consecutive
+    frames are merged into a longer one.
+
+    Args:
+        - duration: duration of one frame in ms
+        - transparency: leave the unchanged pixels of the changed area transparent
     """
-    Function to overlap segmentation map with image
+
+    def __init__(self, duration: float, transparency: bool = True):
+        self.duration = duration
+        self.transparency = transparency
+        self.previous = None
+        # frame_area, offset, duration, unchanged mask of the last frame
+        self.pending = None
+
+    def add(self, frame: ndarray) -> Optional[list]:
+        """Add a frame
+
+        Args:
+            - frame: RGB frame
+        Return:
+            - previous delta frame [frame_area, offset, duration, unchanged], once its duration
+              is final (None if the frame was merged with the previous one)
+        """
+        top, left, unchanged = 0, 0, None
+        if frame is self.previous:
+            self.pending[2] += self.duration
+            return None
+        if self.previous is not None and self.previous.shape == frame.shape:
+            changed = (frame != self.previous).any(axis=2)
+            rows = flatnonzero(changed.any(axis=1))
+            if len(rows) == 0:
+                self.pending[2] += self.duration
+                return None
+            cols = flatnonzero(changed.any(axis=0))
+            top, left = rows[0], cols[0]
+            area = (slice(top, rows[-1] + 1), slice(left, cols[-1] + 1))
+            frame_area = frame[area]
+            if self.transparency:
+                unchanged = ~changed[area]
+                if not unchanged.any():
+                    unchanged = None
+        else:
+            frame_area = frame
+
+        delta_frame = self.flush()
+        self.pending = [frame_area, (int(left), int(top)), self.duration, unchanged]
+        self.previous = frame
+        return delta_frame
+
+    def flush(self) -> Optional[list]:
+        """Get the last delta frame, [frame_area, offset, duration, unchanged] or None"""
+        delta_frame, self.pending = self.pending, None
+        return delta_frame
+
+
+class GifWriter:
+    """Write a .gif file frame by frame, without keeping the previous frames in memory
+
+    Frames go through a GifFrameOptimizer, then they can be quantized and encoded by a pool
+    of processes and are written in order.
 
     Args:
-        - img1: first image
-        - img2: second image
-    Return:
-        - overlap between the two input images
+        - output_path: path of the .gif file to create
+        - fps: fps of the animation
+        - workers: number of processes quantizing and encoding frames
+        - palette: global palette (None to compute a palette for each frame)
+        - transparency: leave the pixels unchanged since the previous frame transparent
     """
-    img1.paste(img2, (0, 0), img2.convert('RGBA'))
 
-    return array(img1)
+    def __init__(
+        self,
+        output_path: str,
+        fps: float,
+        workers: int = 1,
+        palette: Optional[GifPalette] = None,
+        transparency: bool = True,
+    ):
+        self.file = open(output_path, 'wb')
+        self.optimizer = GifFrameOptimizer(1000 / fps, transparency)
+        self.palette = palette
+        self.pool = None
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_all_start_methods, get_context
 
+            # forking while the reading and transforming threads run can deadlock the workers
+            method = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+            self.pool = ProcessPoolExecutor(workers, mp_context=get_context(method))
+        self.window = 2 * workers
+        self.encoding = deque()
+        self.header_written = False
 
-def extract_gif(result_path: str, output_path: str, skip: int, start_idx: int, end_idx: int) -> int:
-    """Extract images from a .gif file to the output_path folder (.png images)
+    def __enter__(self) -> 'GifWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def append_data(self, frame: ndarray) -> None:
+        """Add a frame to the animation
+
+        Args:
+            - frame: RGB frame
+        """
+        self._encode(self.optimizer.add(frame))
+
+    def _encode(self, delta_frame: Optional[list]) -> None:
+        """Encode a delta frame from the optimizer"""
+        if delta_frame is None:
+            return
+        args = (*delta_frame, self.palette, not self.header_written)
+        self.header_written = True
+        if self.pool is None:
+            self._write(encode_gif_frame(*args))
+            return
+        self.encoding.append(self.pool.submit(encode_gif_frame, *args))
+        while len(self.encoding) >= self.window:
+            self._write(self.encoding.popleft().result())
+
+    def _write(self, encoded_frame: List[bytes]) -> None:
+        for data in encoded_frame:
+            self.file.write(data)
+
+    def close(self) -> None:
+        """Write the last frames and close the file"""
+        if self.file.closed:
+            return
+        self._encode(self.optimizer.flush())
+        while self.encoding:
+            self._write(self.encoding.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.file.write(b";")
+        self.file.close()
+
+
+def write_gif(
+    frames: Iterable[ndarray],
+    output_path: str,
+    fps: float,
+    workers: int = 1,
+    palette: Optional[GifPalette] = None,
+    transparency: bool = True,
+) -> None:
+    """Create a .gif file from a stream of frames
 
     Args:
-        - result_path: input gif to extract
-        - output_path: path for output .png images
-        - skip: reduce the number of images: keep 1 frame/skip
-        - start_idx: start index to save images
-        - end_idx: end index to save images
-    Return:
-        - number of frames extracted
+        - frames: iterator over RGB frames
+        - output_path: path of the .gif file to create
+        - fps: fps of the animation
+        - workers: number of processes quantizing and encoding frames
+        - palette: global palette (None to compute a palette for each frame)
+        - transparency: leave the pixels unchanged since the previous frame transparent
     """
-    gif_object = Image.open(result_path)
-    for i, frame in tqdm(enumerate(range(gif_object.n_frames))):
-        if i < start_idx:
-            continue
-        elif i > end_idx:
-            break
-        gif_object.seek(frame)
-        if i % skip == 0:
-            gif_object.save(output_path + "frame_{0:08d}.png".format(i))
-    return gif_object.n_frames
+    makedirs(path.dirname(output_path), exist_ok=True)
+    with GifWriter(output_path, fps, workers, palette, transparency) as writer:
+        for frame in tqdm(frames):
+            profiler.time('encode', writer.append_data, frame, nbytes=frame.nbytes)
 
 
-def extract_video(
-    video_path: str, output_path: str, skip: int, start_idx: int, end_idx: int
-) -> int:
-    """Extract images from a .mp4 file to the output_path folder (.png images)
+class FrameCache:
+    """On-disk cache of transformed frames, with least recently used eviction
+
+    Each entry is a directory named after the hash of its key, holding the frames as .npy
+    chunks of shape (N, H, W, 3) that are memory-mapped when read back.
 
     Args:
-        - result_path: input video to extract
-        - output_path: path for output .png images
-        - skip: reduce the number of images: keep 1 frame/skip.
-        - start_idx: start index to save images
-        - end_idx: end index to save images
-    Return:
-        - number of frames extracted
+        - cache_dir: directory of the cache
+        - max_size: maximum size of the cache in bytes
+        - chunk_size: maximum number of frames per chunk
     """
-    video_capture = cv2.VideoCapture(video_path)
-    success, image = video_capture.read()
-    i = -1
-    while success:
-        i += 1
-        if i < start_idx:
+
+    def __init__(self, cache_dir: str, max_size: int, chunk_size: int = 64):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        makedirs(cache_dir, exist_ok=True)
+        self.evict()
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """Hash the parameters the frames depend on"""
+        return sha1(dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def read(self, key: str, rgb: bool) -> Optional[Iterator[ndarray]]:
+        """Get the frames of an entry
+
+        Args:
+            - key: key of the entry
+            - rgb: True to get RGB frames, False for BGR frames
+        Return:
+            - iterator over the frames (None if the entry is not in the cache)
+        """
+        entry_path = path.join(self.cache_dir, key)
+        if not path.isdir(entry_path):
+            return None
+        # the modification time of an entry is its last use
+        utime(entry_path)
+        chunk_paths = sorted(glob(path.join(entry_path, 'chunk_*.npy')))
+        return self._read_chunks(chunk_paths, path.isfile(path.join(entry_path, 'rgb')) != rgb)
+
+    @staticmethod
+    def _read_chunks(chunk_paths: List[str], convert: bool) -> Iterator[ndarray]:
+        for chunk_path in chunk_paths:
+            for frame in load(chunk_path, mmap_mode='r'):
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if convert else frame
+
+    def write(self, key: str, frames: Iterable[ndarray], rgb: bool) -> Iterator[ndarray]:
+        """Pass frames through while storing them, the entry is added once all are stored
+
+        Args:
+            - key: key of the entry
+            - frames: iterator over the frames to store
+            - rgb: True if frames are RGB, False if BGR
+        Return:
+            - iterator over the same frames
+        """
+        entry_path = path.join(self.cache_dir, key)
+        tmp_path = mkdtemp(prefix='tmp_', dir=self.cache_dir)
+        if rgb:
+            open(path.join(tmp_path, 'rgb'), 'w').close()
+        # frames are appended to the chunk file as they arrive, none is kept in memory
+        chunk, chunk_index = None, 0
+        try:
+            for frame in frames:
+                if chunk is not None and (
+                    len(chunk) == self.chunk_size or chunk.shape != frame.shape
+                ):
+                    chunk.close()
+                    chunk, chunk_index = None, chunk_index + 1
+                if chunk is None:
+                    chunk_path = path.join(tmp_path, 'chunk_{0:08d}.npy'.format(chunk_index))
+                    chunk = FrameStore(chunk_path)
+                chunk.append(frame)
+                yield frame
+            if chunk is not None:
+                chunk.close()
+        except BaseException:
+            if chunk is not None:
+                chunk.close()
+            rmtree(tmp_path, ignore_errors=True)
+            raise
+        rmtree(entry_path, ignore_errors=True)
+        replace(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in max_size"""
+        entries = []
+        for name in listdir(self.cache_dir):
+            entry_path = path.join(self.cache_dir, name)
+            if name.startswith('tmp_') or not path.isdir(entry_path):
+                continue
+            size = sum(path.getsize(chunk) for chunk in glob(path.join(entry_path, '*')))
+            entries.append((path.getmtime(entry_path), size, entry_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+
+
+class FrameStore:
+    """Memory-mapped .npy file of frames of shape (N, H, W, 3)
+
+    Frames are appended to the file one by one, then the whole sequence is read as one
+    memory-mapped array: frames are loaded from disk only when they are used.
+
+    Args:
+        - store_path: path of the .npy file (None for a temporary file removed on close)
+    """
+
+    # magic string, version, header length, header dict padded to a multiple of 64
+    HEADER_SIZE = 128
+
+    def __init__(self, store_path: Optional[str] = None):
+        if store_path is None:
+            fd, store_path = mkstemp(suffix='.npy')
+            self.file = fdopen(fd, 'w+b')
+            self.temporary = True
+        else:
+            self.file = open(store_path, 'w+b')
+            self.temporary = False
+        self.store_path = store_path
+        self.shape = None
+        self.count = 0
+        self.file.write(self._header())
+
+    def __enter__(self) -> 'FrameStore':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _header(self) -> bytes:
+        shape = (self.count,) + (self.shape or (0, 0, 3))
+        header = "{'descr': '|u1', 'fortran_order': False, 'shape': %r, }" % (shape,)
+        header = header.ljust(self.HEADER_SIZE - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + pack('<H', len(header)) + header.encode('latin1')
+
+    def append(self, frame: ndarray) -> None:
+        """Add a frame at the end of the store
+
+        Args:
+            - frame: frame with the same shape as the first one
+        """
+        if self.shape is None:
+            self.shape = frame.shape
+        elif frame.shape != self.shape:
+            raise Exception("All the frames must have the same size to be stored.")
+        self.file.write(ascontiguousarray(frame, dtype=uint8).data)
+        self.count += 1
+
+    def extend(self, frames: Iterable[ndarray]) -> 'FrameStore':
+        """Add frames at the end of the store
+
+        Args:
+            - frames: iterator over frames
+        Return:
+            - the store
+        """
+        for frame in frames:
+            profiler.time('store', self.append, frame, nbytes=frame.nbytes)
+        return self
+
+    @property
+    def frames(self) -> ndarray:
+        """Read-only memory-mapped array of all the frames, shape (N, H, W, 3)"""
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.flush()
+        self.file.seek(0, SEEK_END)
+        if self.count == 0:
+            return empty((0, 0, 0, 3), dtype=uint8)
+        return load(self.store_path, mmap_mode='r')
+
+    def close(self) -> None:
+        """Close the file, it is removed if temporary"""
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.close()
+        if self.temporary:
+            remove(self.store_path)
+
+
+class VideoWriter:
+    """Write a .mp4 file from a dedicated thread fed by a bounded queue
+
+    Encoding overlaps with decoding and transforming the next frames.
+
+    Args:
+        - output_path: path of the .mp4 file to create
+        - fps: fps of the video
+        - size: width and height of the frames
+        - queue_size: maximum number of frames waiting to be encoded
+        - rgb: True if frames are RGB (converted to BGR before encoding), False if BGR
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        fps: float,
+        size: Tuple[int, int],
+        queue_size: int = 16,
+        rgb: bool = True,
+    ):
+        self.video = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+        self.rgb = rgb
+        self.queue = Queue(maxsize=max(queue_size, 1))
+        self.frames_written = 0
+        self.encode_time = 0.0
+        self.error = None
+        self.thread = Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'VideoWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _encode(self) -> None:
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                start = perf_counter()
+                profiler.time('encode', self._write, frame, nbytes=frame.nbytes)
+                self.encode_time += perf_counter() - start
+                self.frames_written += 1
+            except Exception as error:
+                self.error = error
+
+    def _write(self, frame: ndarray) -> None:
+        if self.rgb:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        self.video.write(frame)
+
+    @property
+    def encode_fps(self) -> float:
+        """Number of frames encoded per second of encoding"""
+        return self.frames_written / self.encode_time if self.encode_time > 0 else 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of frames waiting to be encoded"""
+        return self.queue.qsize()
+
+    def write(self, frame: ndarray) -> None:
+        """Add a frame to the video, blocks if the queue is full
+
+        Args:
+            - frame: frame to encode
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self) -> None:
+        """Wait for the queued frames to be encoded and close the file"""
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.video.release()
+        if self.error is not None:
+            raise self.error
+
+
+def write_mp4(
+    frames: Iterable[ndarray],
+    output_path: str,
+    fps: float,
+    queue_size: int = 16,
+    rgb: bool = False,
+) -> None:
+    """Create a .mp4 file from a stream of frames
+
+    Args:
+        - frames: iterator over frames
+        - output_path: path of the .mp4 file to create
+        - fps: fps of the video
+        - queue_size: maximum number of frames waiting to be encoded
+        - rgb: True if frames are RGB, False if BGR
+    """
+    frames = iter(frames)
+    first_frame = next(frames)
+    img_height, img_width, _ = first_frame.shape
+    with VideoWriter(output_path, fps, (img_width, img_height), queue_size, rgb) as video:
+        progress = tqdm(chain([first_frame], frames))
+        for image in progress:
+            video.write(image)
+            progress.set_postfix(
+                encode_fps="{:.1f}".format(video.encode_fps),
+                queue=video.queue_depth,
+                refresh=False,
+            )
+
+
+@lru_cache(maxsize=None)
+def load_overlay(overlay_path: str) -> ImageOverlay:
+    """Load an overlay image once: the jobs of a batch share it and its converted planes"""
+    from PIL import Image
+
+    return ImageOverlay(Image.open(overlay_path))
+
+
+@lru_cache(maxsize=None)
+def get_transform(
+    resize_fact: float,
+    rotate_angle: float,
+    overlay_path: Optional[str],
+    padding: Optional[Tuple[int, ...]],
+    overlap_range: Tuple[int, int],
+    input_rgb: bool,
+    output_rgb: bool,
+    resize_backend: str = 'auto',
+) -> FrameTransform:
+    """Get the frame transformation for the given parameters, created on first use
+
+    The jobs of a batch with the same parameters share the transformation and its warps.
+    """
+    overlay = load_overlay(overlay_path) if overlay_path is not None else None
+    return FrameTransform(
+        resize_fact,
+        rotate_angle,
+        overlay,
+        padding,
+        overlap_range,
+        input_rgb,
+        output_rgb,
+        resize_backend,
+    )
+
+
+def read_manifest(manifest_path: str) -> List[Dict[str, object]]:
+    """Read the jobs of a batch from a .json (list of objects) or .csv (one job per row) file
+
+    Options are named like the long command line options, without the dashes.
+    """
+    with open(manifest_path, newline='') as manifest_file:
+        if manifest_path.split('.')[-1].lower() == 'csv':
+            return list(DictReader(manifest_file))
+        return loads(manifest_file.read())
+
+
+def job_arguments(job: Dict[str, object]) -> List[str]:
+    """Convert the options of a job to command line arguments
+
+    True (or "true") adds a flag, False, "false", None and empty values keep the default.
+    """
+    arguments = []
+    for name, value in job.items():
+        if isinstance(value, str) and value.lower() in ['true', 'false']:
+            value = value.lower() == 'true'
+        if value is None or value is False or value == '':
             continue
-        elif i > end_idx:
-            break
-        stdout.write("\rframe {0}".format(i))
-        stdout.flush()
-        if i % skip == 0:
-            cv2.imwrite(output_path + "frame_{0:08d}.png".format(i), image)
-        success, image = video_capture.read()
-    return i
+        arguments.append('--' + name if value is True else '--{}={}'.format(name, value))
+    return arguments
 
 
-def rotate_image(image: ndarray, angle_deg: float) -> ndarray:
-    """Extract images from a .mp4 file to the output_path folder (.png images)
+def run_batch(parser: ArgumentParser, args: Namespace) -> int:
+    """Run the jobs of a manifest in one process, with a pool of threads
+
+    Options given on the command line are the defaults of every job.
 
     Args:
-        - image: input image to rotate
-        - angle_deg: angle in degrees
+        - parser: command line parser, used to parse the options of the jobs
+        - args: command line arguments, with the manifest path in args.batch
     Return:
-        - rotated image
+        - number of failed jobs
     """
-    h, w = image.shape[:2]
-    img_c = (w / 2, h / 2)
+    jobs = []
+    for job in read_manifest(args.batch):
+        job_args = parser.parse_args(job_arguments(job), namespace=Namespace(**vars(args)))
+        if job_args.input_path is None:
+            raise Exception("No input_path for job: " + dumps(job))
+        jobs.append(job_args)
 
-    rot = cv2.getRotationMatrix2D(img_c, angle_deg, 1)
+    def timed_run(job_args: Namespace) -> Tuple[float, str]:
+        start = perf_counter()
+        try:
+            result = run(job_args)
+        except Exception as e:
+            result = "error: {}".format(e)
+        return perf_counter() - start, result
 
-    rad = radians(angle_deg)
-    sinus = sin(rad)
-    cosinus = cos(rad)
-    b_w = int((h * abs(sinus)) + (w * abs(cosinus)))
-    b_h = int((h * abs(cosinus)) + (w * abs(sinus)))
+    from concurrent.futures import ThreadPoolExecutor
 
-    rot[0, 2] += (b_w / 2) - img_c[0]
-    rot[1, 2] += (b_h / 2) - img_c[1]
+    start = perf_counter()
+    with ThreadPoolExecutor(args.batch_workers) as pool:
+        results = list(pool.map(timed_run, jobs))
+    total = perf_counter() - start
 
-    outImg = cv2.warpAffine(image, rot, (b_w, b_h), flags=cv2.INTER_LINEAR)
-    return outImg
+    print("Batch: {} jobs in {:.2f}s".format(len(jobs), total))
+    for i, (job_args, (duration, result)) in enumerate(zip(jobs, results)):
+        print("{:5d} {:8.2f}s  {} -> {}".format(i, duration, job_args.input_path, result))
+    return sum(result.startswith("error: ") for _, result in results)
 
 
-def main():
+def build_parser() -> ArgumentParser:
     parser = ArgumentParser()
     parser.add_argument(
         "-i",
         "--input_path",
-        required=True,
+        required=False,
+        default=None,
         type=str,
         help="Path to a folder of images (with '\\') or a .gif/.mp4 file.",
     )
@@ -167,6 +1999,14 @@ def main():
         type=str,
         help="Path/to/img.png,number_of_times",
     )
+    parser.add_argument(
+        "--sequence",
+        required=False,
+        default=None,
+        type=str,
+        help="Operations on the order of the transformed frames, applied in order: reverse, "
+        "pingpong, repeat:N, crossfade:N, add:path/to/img.png:N (e.g. 'pingpong,repeat:2').",
+    )
     parser.add_argument(
         "-f",
         "--fps",
@@ -183,6 +2023,15 @@ def main():
         type=float,
         help="Multiply image resolution by given number (default is 1).",
     )
+    parser.add_argument(
+        "--resize_backend",
+        required=False,
+        default="auto",
+        choices=RESIZE_BACKENDS,
+        type=str,
+        help="How to downscale frames: cv2 linear/area interpolation, pyrDown pyramid, "
+        "Pillow reduce, or auto (default): the fastest on this host, timed on first use.",
+    )
     parser.add_argument(
         "-t",
         "--rotate_angle",
@@ -196,7 +2045,7 @@ def main():
         "--keep_extracted_imgs",
         required=False,
         action="store_true",
-        help="To keep the resized images if input is a .gif/.mp4 file.",
+        help="To save the extracted frames to tmp_images/ if input is a .gif/.mp4 file.",
     )
     parser.add_argument(
         "-p",
@@ -206,6 +2055,22 @@ def main():
         type=int,
         help="To reduce the gif size, the script will keep 1 frame / skip.",
     )
+    parser.add_argument(
+        "--target_fps",
+        required=False,
+        default=None,
+        type=float,
+        help="Resample a .gif/.mp4 input to this fps: keep the frames nearest to the output "
+        "timestamps, the output is written at this fps and keeps the input duration.",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        required=False,
+        default=None,
+        type=float,
+        help="Drop the frames whose mean absolute difference (0-255) with the previous kept "
+        "frame, on 32x32 copies, is under this threshold, before transforming them.",
+    )
     parser.add_argument(
         "-n", "--result_name", required=False, default="result", type=str, help="Output name."
     )
@@ -217,6 +2082,13 @@ def main():
         type=str,
         help="Image to overlap with all the others.",
     )
+    parser.add_argument(
+        "--overlap_range",
+        required=False,
+        default="0,{}".format(maxsize),
+        type=str,
+        help="Index of the first and last (excluded) frames to overlap, format: start,end.",
+    )
     parser.add_argument(
         "-m",
         "--mp4",
@@ -249,109 +2121,337 @@ def main():
         help="End frame index.",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "-b",
+        "--buffer_size",
+        required=False,
+        default=16,
+        type=int,
+        help="Maximum number of frames waiting between the read, transform and write stages.",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of threads transforming frames in parallel (default is 1).",
+    )
+
+    parser.add_argument(
+        "--gif_workers",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of processes quantizing and encoding gif frames (default is 1).",
+    )
+    parser.add_argument(
+        "--gif_palette_sample",
+        required=False,
+        default=0,
+        type=int,
+        help="Compute one gif palette from N frames sampled over the whole sequence "
+        "(default is 0: one palette per frame).",
+    )
+
+    parser.add_argument(
+        "--gif_opaque",
+        required=False,
+        action="store_true",
+        help="Store the changed area of gif frames without transparent unchanged pixels.",
+    )
+
+    parser.add_argument(
+        "--read_workers",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of threads decoding the images of an input folder (default is 1).",
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        required=False,
+        default=None,
+        type=str,
+        help="Directory to cache the transformed frames, reused when running again with "
+        "the same input and transformations.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        required=False,
+        default=10240,
+        type=float,
+        help="Maximum size of the cache in MB (default is 10240).",
+    )
+
+    parser.add_argument(
+        "--frame_store",
+        required=False,
+        default=None,
+        nargs='?',
+        const='',
+        type=str,
+        help="Keep the transformed frames in a memory-mapped .npy file instead of memory, "
+        "a temporary file is used if no path is given.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        required=False,
+        default=None,
+        nargs='?',
+        const='',
+        type=str,
+        help="Print the wall time, CPU time, frames and bytes of each stage and the peak "
+        "memory, and save them to the given .json file if a path is given.",
+    )
+
+    parser.add_argument(
+        "--batch",
+        required=False,
+        default=None,
+        type=str,
+        help="Run the jobs of a .json/.csv manifest (one job per input, with its options) "
+        "in one process.",
+    )
+    parser.add_argument(
+        "--batch_workers",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of jobs of the batch run in parallel (default is 1).",
+    )
+    return parser
+
+
+def run(args: Namespace) -> str:
+    """Create the animation for the parsed command line arguments
+
+    Return:
+        - path of the created file
+    """
     input_directory = path.abspath(path.dirname(args.input_path)) + '/'
 
-    images_directory = input_directory
+    if args.target_fps is not None and args.skip != 1:
+        raise Exception("--skip and --target_fps can not be used together.")
+    # the output keeps the duration of the source when it is resampled
+    fps = args.fps if args.target_fps is None else args.target_fps
 
-    index_used_for_extraction = False
+    # channel order of the frames: cv2 decodes BGR, Pillow decodes RGB,
+    # the gif writer needs RGB and the mp4 writer BGR
+    output_rgb = not args.mp4
+    input_rgb = False
+    resize_fact = args.resize_fact
 
-    # if input if gif or video: extract all images
+    # if input is gif or video: decode the frames on the fly
     if path.isfile(args.input_path):
-        index_used_for_extraction = True
-        images_directory += 'tmp_images/'
-        makedirs(images_directory, exist_ok=True)
-
+        sources = [path.abspath(args.input_path)]
         if path.basename(args.input_path).split('.')[-1] in ['gif', 'GIF']:
-            print("Extract gif image...")
-            number_of_frames = extract_gif(
-                args.input_path, images_directory, args.skip, args.start_idx, args.end_idx
+            print("Read gif file...")
+            input_rgb = output_rgb
+            frames = read_gif(
+                args.input_path,
+                args.skip,
+                args.start_idx,
+                args.end_idx,
+                input_rgb,
+                args.target_fps,
             )
         else:
-            print("Extract video file...")
-            number_of_frames = extract_video(
-                args.input_path, images_directory, args.skip, args.start_idx, args.end_idx
+            print("Read video file...")
+            frames = read_video(
+                args.input_path, args.skip, args.start_idx, args.end_idx, args.target_fps
             )
+        frames = profiler.iterate('decode', frames)
 
-        if number_of_frames == 0:
-            raise Exception("Extraction error.")
-    elif not path.isdir(args.input_path):
+        # only spill the frames to disk if they have to be kept
+        if args.keep_extracted_imgs:
+            images_directory = input_directory + 'tmp_images/'
+            makedirs(images_directory, exist_ok=True)
+            frames = save_frames(frames, images_directory, input_rgb)
+    elif path.isdir(args.input_path):
+        if args.target_fps is not None:
+            raise Exception("--target_fps needs a .gif/.mp4 input, images have no timestamps.")
+        images_list_path = sorted(glob(input_directory + '/*' + args.extension))
+        images_list_path = images_list_path[args.start_idx : args.end_idx]
+        if len(images_list_path) == 0:
+            raise Exception(
+                'Not file found with pattern: ' + input_directory + '/*' + args.extension
+            )
+        sources = [path.abspath(image_path) for image_path in images_list_path]
+        print("Read images...")
+        # downscaled images are resized (and decoded at a reduced resolution) when read,
+        # near-duplicates are compared on tiny copies: the full resolution is not needed
+        if resize_fact < 1.0:
+            frames = read_images(
+                images_list_path,
+                args.read_workers,
+                args.buffer_size,
+                resize_fact,
+                args.resize_backend,
+            )
+            resize_fact = 1.0
+        else:
+            frames = read_images(images_list_path, args.read_workers, args.buffer_size)
+    else:
         raise Exception(args.input_path + " does not exist.")
 
-    images_list_path = sorted(glob(images_directory + '/*' + args.extension))
-    if not index_used_for_extraction:
-        images_list_path = images_list_path[args.start_idx : args.end_idx]
-    if len(images_list_path) == 0:
-        raise Exception('Not file found with pattern: ' + images_directory + '/*' + args.extension)
+    padding = None
+    if args.padding is not None:
+        padding = tuple(int(el) for el in args.padding.split(','))
+
+    overlap_range = tuple(int(el) for el in args.overlap_range.split(','))
+    transform = get_transform(
+        resize_fact,
+        args.rotate_angle,
+        args.overlap,
+        padding,
+        overlap_range,
+        input_rgb,
+        output_rgb,
+        args.resize_backend,
+    )
 
-    cv2_images = []
+    cache, cached_frames, dedup = None, None, None
+    stages, store = [], None
+    if args.cache_dir is not None:
+        cache = FrameCache(args.cache_dir, int(args.cache_size * 1024 ** 2))
+        cache_key = FrameCache.key(
+            {
+                'sources': [(source, path.getmtime(source)) for source in sources],
+                'overlap': (args.overlap, path.getmtime(args.overlap)) if args.overlap else None,
+                **{
+                    name: getattr(args, name)
+                    for name in [
+                        'skip',
+                        'target_fps',
+                        'dedup_threshold',
+                        'start_idx',
+                        'end_idx',
+                        'resize_fact',
+                        'resize_backend',
+                        'rotate_angle',
+                        'padding',
+                        'overlap_range',
+                    ]
+                },
+            }
+        )
+        cached_frames = cache.read(cache_key, output_rgb)
 
-    print("\nRead images...")
-    if args.overlap is not None:
-        overlap_image = Image.open(args.overlap)
+    if cached_frames is not None:
+        print("Read frames from cache...")
+        frames = cached_frames
+    else:
+        # near-duplicate frames are dropped before the transformation, in the read thread
+        if args.dedup_threshold is not None:
+            boundaries = overlap_range if args.overlap is not None else ()
+            dedup = FrameDeduplicator(args.dedup_threshold, boundaries=boundaries)
+            frames = dedup.drop(frames)
+            transform = dedup.transform(transform)
 
-    if args.padding is not None:
-        top, bottom, left, right, boderType, r, g, b = [int(el) for el in args.padding.split(',')]
+        # read -> transform -> write, with at most buffer_size frames waiting between stages
+        frames = buffered(frames, args.buffer_size)
+        stages.append(frames)
+        frames = transform_frames(frames, transform, args.workers, args.buffer_size)
+        if dedup is not None:
+            frames = dedup.fill(frames)
+        frames = buffered(frames, args.buffer_size)
+        stages.append(frames)
+        if cache is not None:
+            frames = cache.write(cache_key, frames, output_rgb)
 
-    for i, image_path in tqdm(enumerate(images_list_path)):
-        img = cv2.imread(image_path)
-        img = cv2.resize(
-            img, (int(img.shape[1] * args.resize_fact), int(img.shape[0] * args.resize_fact))
-        )
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        if args.overlap is not None and i < 38:
-            rgb_img = overlap_two_images(Image.fromarray(rgb_img), overlap_image)
-        if args.rotate_angle != 0.0:
-            rgb_img = rotate_image(rgb_img, args.rotate_angle)
-        if args.padding is not None:
-            rgb_img = cv2.copyMakeBorder(
-                rgb_img, top, bottom, left, right, boderType, value=[r, g, b]
+    try:
+        operations = args.sequence.split(',') if args.sequence is not None else []
+        # add image at the end of the frames
+        if args.add_image is not None:
+            img_path, times = args.add_image.split(',')[0], args.add_image.split(',')[1]
+            operations.append('add:{}:{}'.format(img_path, times))
+        # adding images is done on the stream, the other operations need the stored frames
+        reorder = any(operation.partition(':')[0] != 'add' for operation in operations)
+
+        # keep the frames in a memory-mapped file, writers read them from it
+        global_palette = not args.mp4 and args.gif_palette_sample > 0
+        if args.frame_store is not None or global_palette or reorder:
+            store = FrameStore(args.frame_store or None)
+            store.extend(frames)
+            frames = iter(FrameSequence(store.frames, operations, output_rgb))
+        else:
+            for operation in operations:
+                img_path, times = operation.partition(':')[2].rsplit(':', 1)
+                frames = append_image(frames, img_path, int(times), output_rgb)
+
+        first_frame = next(frames, None)
+        if first_frame is None:
+            raise Exception("Extraction error.")
+        frames = chain([first_frame], frames)
+
+        # second pass over the stored frames to compute one palette for the whole gif
+        palette = None
+        if global_palette:
+            print("Compute gif palette...")
+            palette = profiler.time(
+                'palette', GifPalette.from_frames, store.frames, args.gif_palette_sample, nbytes=0
             )
-        cv2_images.append(rgb_img)
-
-    img_height, img_width, _ = rgb_img.shape
-
-    # add image at the end of the cv2_images list
-    if args.add_image is not None:
-        print("Add image...")
-        img_path, times = args.add_image.split(',')[0], args.add_image.split(',')[1]
-        images = cv2.imread(img_path)
-        images = cv2.resize(images, (img_width, img_height))
-        rgb_img = cv2.cvtColor(images, cv2.COLOR_BGR2RGB)
-        for _ in tqdm(range(int(times))):
-            cv2_images.append(rgb_img)
-
-    print("Create animation...")
-
-    # get result path
-    output_result_path = args.output_path
-    if args.output_path is None:
-        output_result_path = input_directory
-    output_result_path = output_result_path + '/' + args.result_name
-
-    if args.mp4:
-        if args.result_name.split('.')[-1] != 'mp4':
-            output_result_path += '.mp4'
-        video = cv2.VideoWriter(
-            output_result_path, cv2.VideoWriter_fourcc(*'mp4v'), args.fps, (img_width, img_height)
-        )
 
-        for image in tqdm(cv2_images):
-            video.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-        video.release()
+        print("Create animation...")
+
+        # get result path
+        output_result_path = args.output_path
+        if args.output_path is None:
+            output_result_path = input_directory
+        output_result_path = output_result_path + '/' + args.result_name
+
+        if args.mp4:
+            if args.result_name.split('.')[-1] != 'mp4':
+                output_result_path += '.mp4'
+            write_mp4(frames, output_result_path, fps, args.buffer_size, output_rgb)
+        else:
+            if args.result_name.split('.')[-1] not in ['gif', 'GIF']:
+                output_result_path += '.gif'
+            write_gif(
+                frames,
+                output_result_path,
+                fps,
+                args.gif_workers,
+                palette,
+                not args.gif_opaque,
+            )
+
+        if dedup is not None:
+            print(dedup.report())
+        return output_result_path
+    finally:
+        # stop the reading and transforming threads, the write stage first as it consumes the other
+        for stage in reversed(stages):
+            stage.close()
+        # remove the temporary frames, even if the animation was not written
+        if store is not None:
+            store.close()
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable()
+    failures = 0
+    if args.batch is not None:
+        failures = run_batch(parser, args)
+    elif args.input_path is None:
+        parser.error("the following arguments are required: -i/--input_path (or --batch)")
     else:
-        if args.result_name.split('.')[-1] not in ['gif', 'GIF']:
-            output_result_path += '.gif'
-        # create gif
-        makedirs(path.dirname(output_result_path), exist_ok=True)
-        with get_writer(output_result_path, mode="I", fps=args.fps) as writer:
-            for frame in tqdm(cv2_images):
-                writer.append_data(frame)
-        writer.close()
-
-    if not args.keep_extracted_imgs and path.isfile(args.input_path):
-        [remove(img) for img in glob(images_directory + '/*')]
-        rmdir(images_directory)
+        run(args)
+
+    if args.profile is not None:
+        print(profiler.table())
+        if args.profile:
+            with open(args.profile, 'w') as profile_file:
+                profile_file.write(dumps(profiler.summary(), indent=1))
+    if failures > 0:
+        exit(1)
 
 
 if __name__ == '__main__':